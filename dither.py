@@ -0,0 +1,57 @@
+import math
+import numpy as np
+
+from numba import njit
+
+# A diffusion kernel is a pair of arrays: (dy, dx) offsets to the pixels
+# that receive error, and the matching weights, which sum to 1.
+FLOYD_STEINBERG = (np.array([(0, 1), (1, -1), (1, 0), (1, 1)], np.int64),
+                   np.array([7, 3, 5, 1], np.float32) / 16)
+
+def diffusion_kernel(sigma=None):
+    # None gives Floyd-Steinberg. Otherwise spread the error over every
+    # not-yet-visited pixel within a radius of about 2 * sigma, weighted by
+    # a Gaussian of its distance.
+    if sigma is None:
+        return FLOYD_STEINBERG
+    if not sigma > 0:
+        raise ValueError(f"sigma must be positive, got {sigma!r}")
+    radius = max(1, math.ceil(2 * sigma))
+    offsets = [(dy, dx)
+               for dy in range(radius + 1)
+               for dx in range(-radius, radius + 1)
+               if dy > 0 or dx > 0]
+    weights = np.array([math.exp(-(dy * dy + dx * dx) / (2 * sigma * sigma))
+                        for dy, dx in offsets], np.float32)
+    return np.array(offsets, np.int64), weights / weights.sum()
+
+def tone_lut(gamma=1.0, contrast=1.0):
+    # Gamma and contrast (around mid-gray) folded into one 256-entry table
+    # for cv2.LUT. Returns None when the table would be the identity.
+    if abs(gamma - 1.0) < 1e-6 and abs(contrast - 1.0) < 1e-6:
+        return None
+    levels = 255.0 * (np.arange(256) / 255.0) ** gamma
+    levels = (levels - 128.0) * contrast + 128.0
+    return np.clip(np.rint(levels), 0, 255).astype(np.uint8)
+
+@njit(cache=True)
+def fs_dither(gray, offsets, weights, out, err):
+    # Fills `out` (uint8) with 1 for black dots, ready for np.packbits.
+    # `err` is float32 scratch of the same shape; both may be reused.
+    height, width = gray.shape
+    err[:, :] = gray
+    for y in range(height):
+        for x in range(width):
+            old = err[y, x]
+            if old < 128.0:
+                out[y, x] = 1
+                diff = old
+            else:
+                out[y, x] = 0
+                diff = old - 255.0
+            for k in range(offsets.shape[0]):
+                ny = y + offsets[k, 0]
+                nx = x + offsets[k, 1]
+                if ny < height and 0 <= nx < width:
+                    err[ny, nx] += diff * weights[k]
+    return out
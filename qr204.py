@@ -1,53 +1,156 @@
 #!/usr/bin/env python3
 from escpos.printer import File
-from PIL import Image, ImageEnhance
 import time
 import cv2
 import math
+import os
 import datetime
 import uuid
 import numpy as np
 import threading
+import signal
+from concurrent.futures import ThreadPoolExecutor
 import RPi.GPIO as GPIO
+from dither import diffusion_kernel, fs_dither, tone_lut
 
-button_locked = False
+button_lock = threading.Lock()  # held from button press until unlock_button
 LED_BUTTON_OUTPUT_PIN = 12  # GPIO pin configured as output
+LED_PWM_HOLD_FREQ = 100  # PWM frequency while the button LED is solid on/off
 BUTTON_PIN = 17
 LED_FLASH_OUTPUT_PIN = 27  # GPIO pin configured as output
 PRINTER_DEVICE = "/dev/usb/lp0"
+RASTER_CHUNK_SIZE = 4096
+_DARKNESS_CMD = b"\x1d\x42"
+_RASTER_INIT = b"\x1d\x28\x01"
+_RASTER_CMD = b"\x1d\x76\x30\x00"  # GS v 0, normal density
+CAMERA_DEVICE = 0
+CAMERA_WIDTH = 640
+CAMERA_HEIGHT = 480
+CAMERA_DRAIN_FRAMES = 2  # stale frames dropped before each capture
+ARCHIVE_JPEG_QUALITY = 85
+GAMMA = 1.0
+CONTRAST = 1.0
+TONE_LUT = tone_lut(GAMMA, CONTRAST)
+DITHER_SIGMA = None  # None keeps Floyd-Steinberg; > 0 widens the kernel
+DITHER_KERNEL = diffusion_kernel(DITHER_SIGMA)
 
-def say_cheeze(image_name):
-    cap = cv2.VideoCapture(0)
-    ret, frame = cap.read()
-    if ret:
-        cv2.imwrite(image_name, frame)
+camera = None
+led_pwm = None
+printer = None
+archive_pool = ThreadPoolExecutor(max_workers=1)
+archive_future = None
+footer_cache = (None, None)  # (day ordinal, encoded footer)
+buffers = {}  # scratch arrays reused between presses, see reuse_buffer
+
+def open_camera(device_index=CAMERA_DEVICE):
+    cap = cv2.VideoCapture(device_index, cv2.CAP_V4L2)
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_HEIGHT)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap
+
+def save_frame(frame, image_name):
+    if cv2.imwrite(image_name, frame, [cv2.IMWRITE_JPEG_QUALITY, ARCHIVE_JPEG_QUALITY]):
         print("Image saved as", image_name)
     else:
+        print("Failed to save", image_name)
+
+def archive_frame(frame, image_name):
+    # Encode and write on the archive thread so printing is not held up.
+    global archive_future
+    archive_future = archive_pool.submit(save_frame, frame, image_name)
+    return archive_future
+
+def reuse_buffer(name, shape, dtype=np.uint8):
+    # Hand back the array kept under `name` while its shape still fits, so
+    # steady-state presses do not allocate new images.
+    buf = buffers.get(name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = buffers[name] = np.empty(shape, dtype)
+    return buf
+
+def keep_camera_warm(stop_event):
+    # Keep the sensor streaming so exposure and white balance have settled
+    # by the time the flash is on and the real frame is taken.
+    # Stop at the first failed grab (device missing or unplugged) rather
+    # than spinning; say_cheeze reports the failure.
+    while not stop_event.is_set():
+        if not camera.grab():
+            break
+
+def say_cheeze():
+    for _ in range(CAMERA_DRAIN_FRAMES):
+        camera.grab()
+    # The previous frame may still be on its way to disk; finish that
+    # before retrieve() overwrites the shared buffer.
+    if archive_future is not None:
+        archive_future.result()
+    ret, frame = camera.retrieve(buffers.get("frame"))
+    if not ret:
         print("Failed to capture image")
-    cap.release()
-
-def convert_image(input_path, width=384, num_colors=254):
-    img = Image.open(input_path)
-    img = img.rotate(90, expand=True)
-    img = img.resize((width, int(width * img.height / img.width)))
-    img = img.convert("L")
-    enhancer = ImageEnhance.Contrast(img)
-    img = enhancer.enhance(1)
-    img = img.convert("P", palette=Image.ADAPTIVE, colors=num_colors)
-    return img
-
-def print_image_with_darkness(printer_dev, img, darkness=0x1E):
+        return None
+    buffers["frame"] = frame
+    return frame
+
+def convert_image(frame, width=384, lut=TONE_LUT):
+    # Shrink first, then rotate: the frame is turned 90 degrees, so its
+    # height becomes the print width.
+    frame_height, frame_width = frame.shape[:2]
+    length = int(width * frame_width / frame_height)
+    small = cv2.resize(frame, (length, width),
+                       dst=reuse_buffer("small", (width, length, 3)),
+                       interpolation=cv2.INTER_AREA)
+    small = cv2.rotate(small, cv2.ROTATE_90_COUNTERCLOCKWISE,
+                       dst=reuse_buffer("rotated", (length, width, 3)))
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY,
+                        dst=reuse_buffer("gray", (length, width)))
+    if lut is not None:
+        gray = cv2.LUT(gray, lut, dst=reuse_buffer("toned", gray.shape))
+    return fs_dither(gray, *DITHER_KERNEL,
+                     reuse_buffer("ink", gray.shape),
+                     reuse_buffer("error", gray.shape, np.float32))
+
+def print_raster(p, ink):
+    # GS v 0 expects one bit per dot, MSB first, 1 = black, which is
+    # what fs_dither produces.
+    packed = np.packbits(ink, axis=1)
+    height, row_bytes = packed.shape
+    header = _RASTER_CMD + bytes((row_bytes & 0xFF, row_bytes >> 8,
+                                  height & 0xFF, height >> 8))
+    p._raw(header)
+    p.device.flush()
+    # Stream the payload in blocks so the kernel only holds one block
+    # while the printer burns the previous one.
+    fd = p.device.fileno()
+    payload = memoryview(packed.tobytes())
+    for start in range(0, len(payload), RASTER_CHUNK_SIZE):
+        block = payload[start:start + RASTER_CHUNK_SIZE]
+        while block:
+            block = block[os.write(fd, block):]
+
+def open_printer(printer_dev, darkness=0x1E):
+    # Darkness and raster init stick until the printer is reset, so they
+    # are sent once here rather than before every picture.
     p = File(printer_dev)
-    p._raw(bytes([0x1D, 0x42, darkness]))
-    time.sleep(0.1)
-    p._raw(bytes([0x1D, 0x28, 0x01]))
-    p.image(img, impl="bitImageRaster")
-    p.text("\n")
-    current_date = datetime.datetime.now().strftime("%d-%m-%Y")
-    p.text(f"           {current_date}")
+    p._raw(_DARKNESS_CMD + bytes((darkness,)) + _RASTER_INIT)
+    return p
+
+def date_footer():
+    # The footer only changes at midnight, so keep the encoded bytes for
+    # the current day.
+    global footer_cache
+    today = datetime.date.today()
+    if footer_cache[0] != today.toordinal():
+        text = f"\n           {today.strftime('%d-%m-%Y')}"
+        footer_cache = (today.toordinal(), text.encode("ascii"))
+    return footer_cache[1]
+
+def print_image(p, img):
+    print_raster(p, img)
+    p._raw(date_footer())
     p.print_and_feed(1)
     p.cut()
-    p.close()
 
 
 # def print_image_with_darkness(printer_dev, image_input, darkness=0x1E, delay=0.2, block_height=15):
@@ -98,64 +201,86 @@ def print_image_with_darkness(printer_dev, img, darkness=0x1E):
 #     p.cut()
 #     p.close()
 
+# The PWM channel owns the button LED for the whole run: solid on/off is
+# duty 100/0. Stopping soft PWM is asynchronous, so it is never stopped
+# and restarted, and the pin is never written with GPIO.output.
+def set_button_led(on):
+    led_pwm.ChangeFrequency(LED_PWM_HOLD_FREQ)
+    led_pwm.ChangeDutyCycle(100 if on else 0)
+
 def blink_led_for_duration(duration, blink_interval):
-    start_time = time.time()
-    while time.time() - start_time < duration:
-        GPIO.output(LED_BUTTON_OUTPUT_PIN, GPIO.HIGH)
-        time.sleep(blink_interval)
-        GPIO.output(LED_BUTTON_OUTPUT_PIN, GPIO.LOW)
-        time.sleep(blink_interval)
+    led_pwm.ChangeFrequency(1 / (2 * blink_interval))
+    led_pwm.ChangeDutyCycle(50)
+    time.sleep(duration)
 
 def blink_led_sequence():
     sequence = [(2, 0.5), (2, 0.25), (2, 0.1)]
     for duration, interval in sequence:
         blink_led_for_duration(duration, interval)
-    GPIO.output(LED_BUTTON_OUTPUT_PIN, GPIO.HIGH)
+    set_button_led(True)
     time.sleep(1)
 
 def picture(channel):
 
-    global button_locked
-    if button_locked:
+    if not button_lock.acquire(blocking=False):
         return
     print("Button pressed!")
-    button_locked = True
-    blink_led_sequence()
-    current_date = datetime.datetime.now().strftime("%Y_%m_%d")
-    image_name = f"{current_date}_{uuid.uuid4()}.png"
-    GPIO.output(LED_FLASH_OUTPUT_PIN, GPIO.LOW)
-    print("Image caputirng, printing...")
-    time.sleep(1)
-    say_cheeze(image_name)
+    warm_stop = threading.Event()
+    warm_thread = threading.Thread(target=keep_camera_warm, args=(warm_stop,))
+    warm_thread.start()
+    try:
+        blink_led_sequence()
+        current_date = datetime.datetime.now().strftime("%Y_%m_%d")
+        image_name = f"{current_date}_{uuid.uuid4()}.jpg"
+        GPIO.output(LED_FLASH_OUTPUT_PIN, GPIO.LOW)
+        print("Image caputirng, printing...")
+        time.sleep(1)
+    finally:
+        warm_stop.set()
+        warm_thread.join()
+    frame = say_cheeze()
     GPIO.output(LED_FLASH_OUTPUT_PIN, GPIO.HIGH)
-    img = convert_image(image_name)
+    if frame is None:
+        threading.Timer(2, unlock_button).start()
+        return
+    archive_frame(frame, image_name)
+    img = convert_image(frame)
     print("Image converted, printing...")
-    GPIO.output(LED_BUTTON_OUTPUT_PIN, GPIO.LOW)
-    print_image_with_darkness(PRINTER_DEVICE, img, darkness=0x2A)
+    set_button_led(False)
+    print_image(printer, img)
     threading.Timer(2, unlock_button).start()
 
 def unlock_button():
-    global button_locked
-    button_locked = False
-    GPIO.output(LED_BUTTON_OUTPUT_PIN, GPIO.HIGH)
+    button_lock.release()
+    set_button_led(True)
     print("Button unlocked.")
 
 if __name__ == "__main__":
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
     GPIO.setup(LED_BUTTON_OUTPUT_PIN, GPIO.OUT)
-    GPIO.output(LED_BUTTON_OUTPUT_PIN, GPIO.HIGH)
+    led_pwm = GPIO.PWM(LED_BUTTON_OUTPUT_PIN, LED_PWM_HOLD_FREQ)
+    led_pwm.start(100)
     GPIO.setup(LED_FLASH_OUTPUT_PIN, GPIO.OUT)
     GPIO.output(LED_FLASH_OUTPUT_PIN, GPIO.HIGH)
 
 
-    GPIO.add_event_detect(BUTTON_PIN, GPIO.FALLING, callback=picture, bouncetime=1500)
-    print("Waiting for a button press... (Press Ctrl+C to exit)")
     try:
+        camera = open_camera()
+        printer = open_printer(PRINTER_DEVICE, darkness=0x2A)
+        GPIO.add_event_detect(BUTTON_PIN, GPIO.FALLING, callback=picture, bouncetime=1500)
+        print("Waiting for a button press... (Press Ctrl+C to exit)")
         picture(2)
-        while True:
-            time.sleep(1)
+        signal.pause()
     except KeyboardInterrupt:
         print("Exiting program...")
     finally:
+        if camera is not None:
+            camera.release()
+        if printer is not None:
+            printer.close()
+        archive_pool.shutdown(wait=True)
+        # Let the PWM thread finish its last period before cleanup.
+        led_pwm.stop()
+        time.sleep(2 / LED_PWM_HOLD_FREQ)
         GPIO.cleanup()